@@ -1,34 +1,82 @@
 from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional, Tuple
 import uuid
+import time
 from datetime import datetime, timezone
 import pdfplumber
-import io
+import shutil
+import tempfile
 import re
-from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz, process, utils
 import colorsys
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+from collections import OrderedDict, defaultdict
+import numpy as np
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# Timestamps are stored as BSON dates; tz_aware keeps them UTC-aware when read back
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
-# Create the main app without a prefix
-app = FastAPI()
+# Distinct keywords whose matches are memoized per catalog
+MATCH_CACHE_SIZE = 2048
+
+# Scores are compared after rounding (as fuzzywuzzy's integer scores were), so a
+# float score passes a cutoff once it is within half a point of it
+ROUNDING_SLACK = 0.5
+
+# Character n-gram length used by the substring index
+NGRAM_SIZE = 3
+
+# Upper bound on pricing items read back from MongoDB in one query
+MAX_ITEMS = int(os.environ.get('MAX_ITEMS', '100000'))
+
+# Maximum documents sent per insert_many call when storing an uploaded table
+INSERT_BATCH_SIZE = 10000
+
+# Create the main app without a prefix; responses are serialized with orjson
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# In-process cache of the pricing table as parallel NumPy object arrays (structure-of-arrays),
+# keyed on the id of the default PDF it was loaded for. Every request checks that id, so
+# each worker process reloads after an upload handled by any of them.
+CATALOG_FIELDS = ('id', 'produto', 'valor_venda', 'limite_sistema', 'limite_tabela', 'cinco_porcento')
+CATALOG_PROJECTION = {"_id": 0, **{field: 1 for field in CATALOG_FIELDS}}
+_catalog_lock = asyncio.Lock()
+_items_cache: Optional[dict] = None
+
+# Favorited item names, mirrored in memory and updated alongside every write made by this
+# process; reloaded after FAVORITES_TTL seconds to pick up writes from other worker processes
+FAVORITES_TTL = 5.0
+_favorites_cache: Optional[set] = None
+_favorites_loaded_at = 0.0
+_favorites_lock = asyncio.Lock()
+
+# Worker processes for CPU-bound PDF parsing, created on the first upload
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
 # Define Models
 class PricingItem(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -39,10 +87,6 @@ class PricingItem(BaseModel):
     limite_sistema: str
     limite_tabela: str
     cinco_porcento: str
-    valor_venda_color: Optional[str] = None
-    limite_sistema_color: Optional[str] = None
-    limite_tabela_color: Optional[str] = None
-    cinco_porcento_color: Optional[str] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class PDFMetadata(BaseModel):
@@ -56,6 +100,7 @@ class PDFMetadata(BaseModel):
 
 class BatchQuotationRequest(BaseModel):
     item_names: List[str]
+    top_k: Optional[int] = Field(default=None, ge=1)  # Max matches returned per keyword (None = all)
 
 class FavoriteRequest(BaseModel):
     item_name: str
@@ -71,11 +116,6 @@ class MatchedItemDetail(BaseModel):
     cinco_porcento_display: str
     fallback_applied: bool
     is_favorite: bool
-    # Color coding
-    valor_venda_color: Optional[str] = None
-    limite_sistema_color: Optional[str] = None
-    limite_tabela_color: Optional[str] = None
-    cinco_porcento_color: Optional[str] = None
 
 class GreenLimitItem(BaseModel):
     """Item with empty 5% and green-highlighted Limite Tabela"""
@@ -218,98 +258,334 @@ def clean_price_value(value: str) -> str:
         return ''
     return value.strip()
 
-def parse_pdf_pricing_table(pdf_bytes: bytes) -> List[dict]:
-    """Parse PDF and extract pricing table data with enhanced color detection"""
+def table_to_items(table: List[list]) -> List[dict]:
+    """Convert the rows of an extracted pricing table (after its header row) into items"""
+    cpv = clean_price_value
+    # Invariant: produto and every price field are stored already stripped,
+    # so request handlers never need to strip them again
+    return [
+        {
+            'produto': produto,
+            'valor_venda': cpv(row[1]),
+            'limite_sistema': cpv(row[2]),
+            'limite_tabela': cpv(row[3]),
+            'cinco_porcento': cpv(row[4]),
+        }
+        for row in table[1:]
+        if len(row) >= 5 and row[0] and (produto := row[0].strip())
+    ]
+
+def parse_pdf_pages(pdf_path: str, page_indices: List[int]) -> List[dict]:
+    """Extract pricing table rows from the given pages of a PDF"""
     items = []
     
-    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-        for page_num, page in enumerate(pdf.pages):
+    with pdfplumber.open(pdf_path) as pdf:
+        for page_num in page_indices:
+            page = pdf.pages[page_num]
             tables = page.extract_tables()
             
             for table in tables:
-                for row_idx, row in enumerate(table[1:], start=1):
-                    if len(row) >= 5 and row[0]:
-                        produto = row[0].strip() if row[0] else ''
-                        
-                        if not produto:
-                            continue
-                        
-                        try:
-                            valor_venda_color = None
-                            limite_sistema_color = None
-                            limite_tabela_color = None
-                            cinco_porcento_color = None
-                            
-                        except Exception as e:
-                            logging.debug(f"Color detection error for row: {str(e)}")
-                        
-                        item = {
-                            'produto': produto,
-                            'valor_venda': clean_price_value(row[1]),
-                            'limite_sistema': clean_price_value(row[2]),
-                            'limite_tabela': clean_price_value(row[3]),
-                            'cinco_porcento': clean_price_value(row[4]),
-                            'valor_venda_color': valor_venda_color,
-                            'limite_sistema_color': limite_sistema_color,
-                            'limite_tabela_color': limite_tabela_color,
-                            'cinco_porcento_color': cinco_porcento_color,
-                        }
-                        items.append(item)
+                items.extend(table_to_items(table))
+            # Drop the page's cached chars/objects/layout so memory stays at about one page
+            page.close()
             
             logging.info(f"Processed page {page_num + 1}, found {len(items)} items so far")
     
     return items
 
-def check_exact_match(query: str, item_name: str) -> bool:
-    """Check if query exactly matches the full item name"""
-    return query.strip().lower() == item_name.strip().lower()
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """Get the process pool used to parse PDF pages, creating it on first use"""
+    global _pdf_pool
+    # Called from executor threads, so creation is guarded by a thread lock
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # Workers come from a forkserver rather than a fork of this multithreaded
+            # server, so they never inherit locks held by other threads (logging, Motor)
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _pdf_pool
+
+def discard_pdf_pool(pool: ProcessPoolExecutor):
+    """Drop a broken process pool so the next upload starts a fresh one"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def parse_pdf_pricing_table(pdf_path: str) -> List[dict]:
+    """Parse PDF and extract pricing table data, spreading the pages over worker processes"""
+    with pdfplumber.open(pdf_path) as pdf:
+        page_count = len(pdf.pages)
+    
+    # Forking workers costs more than parsing a single page (or running on a single core)
+    workers = min(os.cpu_count() or 1, page_count)
+    if workers <= 1:
+        return parse_pdf_pages(pdf_path, list(range(page_count)))
+    
+    chunks = [
+        list(range(i * page_count // workers, (i + 1) * page_count // workers))
+        for i in range(workers)
+    ]
+    
+    items = []
+    pool = get_pdf_pool()
+    try:
+        for chunk_items in pool.map(parse_pdf_pages, repeat(pdf_path), chunks):
+            items.extend(chunk_items)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); without this every later upload would fail
+        discard_pdf_pool(pool)
+        raise
+    
+    return items
 
-def fuzzy_match_multiple(query: str, all_items: List[dict], threshold: int = 60) -> tuple:
-    """Find all items matching the query"""
-    if not all_items:
+def fuzzy_match_multiple(query: str, catalog: dict, threshold: int = 60,
+                         token_row: Optional[np.ndarray] = None) -> tuple:
+    """
+    Find all catalog items matching the query, returned as (index, score) pairs.
+    token_row holds precomputed token-sort scores against every catalog name
+    (0 below the threshold), as produced by match_keywords.
+    """
+    if not catalog["size"]:
         return (False, [])
     
     matches = []
     query_lower = query.lower().strip()
     exact_match_found = False
+    items_lower = catalog["lower"]
+    
+    idx = catalog["exact_index"].get(query_lower)
+    if idx is not None:
+        matches = [(idx, 100)]
+        exact_match_found = True
+        return (exact_match_found, matches)
     
-    for item in all_items:
-        if check_exact_match(query, item['produto']):
-            matches = [(item, 100)]
-            exact_match_found = True
-            return (exact_match_found, matches)
+    # Candidates are collected as (-score, produto, index) so a plain sort
+    # orders them by score then name using native tuple comparison
+    produto = catalog["produto"]
     
-    for item in all_items:
-        item_name = item['produto']
-        item_name_lower = item_name.lower()
+    substring_hits = lookup_substring(catalog, query_lower)
+    matches.extend((-95, produto[idx], idx) for idx in substring_hits)
+    
+    # Items containing every query word as a substring; the longest word narrows
+    # the candidates first and each shorter word only filters what is left
+    word_hits = None
+    for word in sorted(set(query_lower.split()), key=len, reverse=True):
+        word_hits = lookup_substring(catalog, word, within=word_hits)
+        if not word_hits:
+            break
+    word_hits = (word_hits or set()) - substring_hits
+    matches.extend((-85, produto[idx], idx) for idx in word_hits)
+    
+    # Only the fuzzy scorers still need to look at every remaining item
+    remaining = {
+        idx: name for idx, name in enumerate(items_lower)
+        if idx not in substring_hits and idx not in word_hits
+    }
+    
+    # token_sort_ratio first, as a plain ratio against the token strings
+    # normalized and sorted once at cache build time
+    if token_row is None:
+        token_row = token_ratio_matrix([sort_tokens(query_lower)], catalog["sorted_tokens"], threshold)[0]
+    for idx in np.flatnonzero(token_row).tolist():
+        if idx in remaining:
+            matches.append((-round(float(token_row[idx])), produto[idx], idx))
+            del remaining[idx]
+    
+    # Then partial_ratio, with a stricter cutoff, on whatever is left
+    partial_hits = process.extract(
+        query_lower, remaining, scorer=fuzz.partial_ratio,
+        processor=None, score_cutoff=threshold + 10 - ROUNDING_SLACK, limit=None
+    )
+    matches.extend((-round(partial_score), produto[idx], idx) for _, partial_score, idx in partial_hits)
+    
+    matches.sort()
+    
+    return (exact_match_found, [(idx, -neg_score) for neg_score, _, idx in matches])
+
+def token_ratio_matrix(queries: List[str], choices: List[str], threshold: int) -> np.ndarray:
+    """Score every sorted-token query against every sorted-token choice in one native call"""
+    return process.cdist(
+        queries, choices, scorer=fuzz.ratio, processor=None,
+        score_cutoff=threshold - ROUNDING_SLACK, dtype=np.float32, workers=-1
+    )
+
+def match_keywords(catalog: dict, queries: List[str], threshold: int = 60) -> List[tuple]:
+    """Match several normalized keywords, scoring the non-exact ones in a single cdist pass"""
+    fuzzy_queries = [query for query in queries if query not in catalog["exact_index"]]
+    token_rows = {}
+    if fuzzy_queries:
+        matrix = token_ratio_matrix(
+            [sort_tokens(query) for query in fuzzy_queries], catalog["sorted_tokens"], threshold
+        )
+        token_rows = dict(zip(fuzzy_queries, matrix))
+    
+    results = []
+    for query in queries:
+        exact_match_found, matches = fuzzy_match_multiple(
+            query, catalog, threshold, token_row=token_rows.get(query)
+        )
+        results.append((exact_match_found, tuple(matches)))
+    return results
+
+async def match_keywords_cached(catalog: dict, queries: List[str], threshold: int = 60) -> List[tuple]:
+    """Match normalized keywords through the catalog's LRU memo, scoring the misses in a worker thread"""
+    memo = catalog["match_memo"]
+    # Hits are taken before awaiting, since a concurrent request may evict them meanwhile
+    found = {query: memo[(query, threshold)] for query in queries if (query, threshold) in memo}
+    missing = [query for query in queries if query not in found]
+    if missing:
+        computed = await asyncio.to_thread(match_keywords, catalog, missing, threshold)
+        found.update(zip(missing, computed))
+        memo.update(zip(((query, threshold) for query in missing), computed))
+    
+    for query in queries:
+        if (query, threshold) in memo:
+            memo.move_to_end((query, threshold))
+    while len(memo) > MATCH_CACHE_SIZE:
+        memo.popitem(last=False)
+    return [found[query] for query in queries]
+
+def ngrams(text: str, size: int = NGRAM_SIZE) -> set:
+    """All character n-grams of the text"""
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+def build_index(keys_per_item: List[set]) -> dict:
+    """Build an inverted index mapping each key to the indices of the items that have it"""
+    index = defaultdict(set)
+    for idx, keys in enumerate(keys_per_item):
+        for key in keys:
+            index[key].add(idx)
+    return dict(index)
+
+def lookup_substring(catalog: dict, text: str, within: Optional[set] = None) -> set:
+    """Indices of the items (optionally among `within`) whose lowercased name contains text"""
+    # A name can only contain the text if it has every trigram of it, so candidates
+    # come from the trigram index and are then confirmed with `in`
+    if within is None:
+        if len(text) >= NGRAM_SIZE:
+            within = lookup_all(catalog["trigram_index"], ngrams(text))
+        else:
+            within = range(catalog["size"])
+    items_lower = catalog["lower"]
+    return {idx for idx in within if text in items_lower[idx]}
+
+def lookup_all(index: dict, keys: set) -> set:
+    """Indices of the items that have every one of the keys"""
+    postings = [index.get(key) for key in keys]
+    if not postings or None in postings:
+        return set()
+    postings.sort(key=len)
+    return postings[0].intersection(*postings[1:])
+
+def sort_tokens(text: str) -> str:
+    """Normalize text the way token_sort_ratio does and join its tokens in sorted order"""
+    return ' '.join(sorted(utils.default_process(text).split()))
+
+def build_items_cache(all_items: List[dict], pdf_id: Optional[str]) -> dict:
+    """Split the pricing items into parallel field lists plus the normalized name forms used for matching"""
+    catalog = {
+        field: np.array([item.get(field) for item in all_items], dtype=object)
+        for field in CATALOG_FIELDS
+    }
+    items_lower = [name.lower() for name in catalog['produto']]
+    exact_index = {}
+    for idx, name in enumerate(items_lower):
+        exact_index.setdefault(name, idx)
+    catalog.update(
+        pdf_id=pdf_id,
+        size=len(all_items),
+        lower=items_lower,
+        exact_index=exact_index,
+        sorted_tokens=[sort_tokens(name) for name in items_lower],
+        trigram_index=build_index([ngrams(name) for name in items_lower]),
+        # Keyword results are memoized per catalog, so an upload starts with an empty memo.
+        # It is only touched from the event loop, so it needs no lock.
+        match_memo=OrderedDict(),
+    )
+    return catalog
+
+async def get_items_cache() -> dict:
+    """Get the cached pricing table, reloading it from MongoDB when the default PDF changed"""
+    global _items_cache
+    # One indexed lookup per request; the table itself is only read again after an upload
+    default_pdf = await db.pdf_metadata.find_one({"is_default": True}, {"_id": 0, "id": 1})
+    pdf_id = default_pdf["id"] if default_pdf else None
+    if _items_cache is None or _items_cache["pdf_id"] != pdf_id:
+        async with _catalog_lock:
+            if _items_cache is None or _items_cache["pdf_id"] != pdf_id:
+                cursor = db.pricing_items.find({}, CATALOG_PROJECTION).limit(MAX_ITEMS)
+                all_items = [doc async for doc in cursor]
+                _items_cache = build_items_cache(all_items, pdf_id)
+    return _items_cache
+
+def build_matched_items(matches: List[tuple], catalog: dict, favorites_set: set,
+                        limit: Optional[int] = None) -> List[MatchedItemDetail]:
+    """Materialize (index, score) matches into response items, favorites first"""
+    # Matches are already sorted, so the top `limit` (favorites first) is a slice
+    # and only those rows get materialized
+    if limit is not None and len(matches) > limit:
+        produto = catalog["produto"]
+        matches = (
+            [match for match in matches if produto[match[0]] in favorites_set]
+            + [match for match in matches if produto[match[0]] not in favorites_set]
+        )[:limit]
+    
+    # The values come from our own catalog, so the response models are built
+    # with model_construct and skip pydantic validation
+    favorites = []
+    non_favorites = []
+    
+    # Gather every column for all matched indices in one vectorized slice each
+    idxs = np.fromiter((idx for idx, _ in matches), dtype=np.intp, count=len(matches))
+    rows = zip(*(catalog[field][idxs].tolist() for field in CATALOG_FIELDS))
+    
+    for item_id, produto, valor_venda, limite_sistema, limite_tabela, cinco_porcento in rows:
+        valor_venda = valor_venda or ''
+        limite_sistema = limite_sistema or ''
+        limite_tabela = limite_tabela or ''
+        cinco_porcento = cinco_porcento or ''
         
-        if query_lower in item_name_lower:
-            score = 95
-            matches.append((item, score))
-            continue
+        fallback_applied = False
+        cinco_porcento_display = cinco_porcento
         
-        query_words = query_lower.split()
-        if all(word in item_name_lower for word in query_words):
-            matches.append((item, 85))
-            continue
+        if not cinco_porcento or cinco_porcento == '':
+            cinco_porcento_display = limite_tabela if limite_tabela else 'N/A'
+            fallback_applied = True if limite_tabela else False
         
-        token_score = fuzz.token_sort_ratio(query_lower, item_name_lower)
-        if token_score >= threshold:
-            matches.append((item, token_score))
-            continue
+        is_favorite = produto in favorites_set
         
-        partial_score = fuzz.partial_ratio(query_lower, item_name_lower)
-        if partial_score >= threshold + 10:
-            matches.append((item, partial_score))
-    
-    matches.sort(key=lambda x: (-x[1], x[0]['produto']))
+        item_detail = MatchedItemDetail.model_construct(
+            item_id=item_id,
+            matched_item_name=produto,
+            valor_venda=valor_venda if valor_venda else 'N/A',
+            limite_sistema=limite_sistema if limite_sistema else 'N/A',
+            limite_tabela=limite_tabela if limite_tabela else 'N/A',
+            cinco_porcento_original=cinco_porcento if cinco_porcento else 'N/A',
+            cinco_porcento_display=cinco_porcento_display if cinco_porcento_display else 'N/A',
+            fallback_applied=fallback_applied,
+            is_favorite=is_favorite
+        )
+        
+        if is_favorite:
+            favorites.append(item_detail)
+        else:
+            non_favorites.append(item_detail)
     
-    return (exact_match_found, matches)
+    return favorites + non_favorites
 
 async def get_favorites_set() -> set:
-    """Get set of favorited item names"""
-    favorites = await db.favorites.find({}, {"_id": 0, "item_name": 1}).to_list(10000)
-    return {fav['item_name'] for fav in favorites}
+    """Get set of favorited item names, reloaded from MongoDB once it is older than FAVORITES_TTL"""
+    global _favorites_cache, _favorites_loaded_at
+    if _favorites_cache is None or time.monotonic() - _favorites_loaded_at > FAVORITES_TTL:
+        async with _favorites_lock:
+            if _favorites_cache is None or time.monotonic() - _favorites_loaded_at > FAVORITES_TTL:
+                favorites = await db.favorites.find({}, {"_id": 0, "item_name": 1}).to_list(10000)
+                _favorites_cache = {fav['item_name'] for fav in favorites}
+                _favorites_loaded_at = time.monotonic()
+    return _favorites_cache
 
 @api_router.get("/")
 async def root():
@@ -318,36 +594,59 @@ async def root():
 @api_router.post("/upload-pdf", response_model=UploadResponse)
 async def upload_pdf(file: UploadFile = File(...)):
     """Upload and parse PDF pricing table with enhanced color detection"""
+    global _items_cache
+    # One upload timestamp shared by every row and the metadata document
+    upload_time = datetime.now(timezone.utc)
     try:
         if not file.filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are allowed")
         
-        pdf_bytes = await file.read()
-        items = parse_pdf_pricing_table(pdf_bytes)
+        # Spool the upload to a named file so parser workers can open it by path
+        # instead of holding (and pickling) the whole body in memory
+        loop = asyncio.get_running_loop()
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as pdf_file:
+            await loop.run_in_executor(None, shutil.copyfileobj, file.file, pdf_file)
+            pdf_file.flush()
+            items = await loop.run_in_executor(None, parse_pdf_pricing_table, pdf_file.name)
         
         if not items:
             raise HTTPException(status_code=400, detail="No pricing data found in PDF")
         
-        await db.pdf_metadata.update_many({}, {"$set": {"is_default": False}})
-        await db.pricing_items.delete_many({})
+        # Retiring the old default and dropping the old catalog are independent,
+        # so send both at once; dropping is a metadata operation, unlike deleting every document
+        await asyncio.gather(
+            db.pdf_metadata.update_many({}, {"$set": {"is_default": False}}),
+            db.pricing_items.drop(),
+        )
         
-        items_with_metadata = []
-        for item in items:
-            pricing_item = PricingItem(**item)
-            doc = pricing_item.model_dump()
-            doc['timestamp'] = doc['timestamp'].isoformat()
-            items_with_metadata.append(doc)
+        # Rows come straight from our own parser, so skip per-row PricingItem validation
+        items_with_metadata = [
+            {"id": str(uuid.uuid4()), **item, "timestamp": upload_time} for item in items
+        ]
         
-        await db.pricing_items.insert_many(items_with_metadata)
+        # Order is irrelevant on a fresh collection, so let the server apply
+        # unordered batches and send them concurrently
+        await asyncio.gather(*(
+            db.pricing_items.insert_many(
+                items_with_metadata[start:start + INSERT_BATCH_SIZE], ordered=False
+            )
+            for start in range(0, len(items_with_metadata), INSERT_BATCH_SIZE)
+        ))
         
+        # The new default is only published once every row is stored, so a worker
+        # that sees its id always loads the complete table
         pdf_meta = PDFMetadata(
             filename=file.filename,
             items_count=len(items),
+            upload_timestamp=upload_time,
             is_default=True
         )
-        meta_doc = pdf_meta.model_dump()
-        meta_doc['upload_timestamp'] = meta_doc['upload_timestamp'].isoformat()
-        await db.pdf_metadata.insert_one(meta_doc)
+        await db.pdf_metadata.insert_one(pdf_meta.model_dump())
+        
+        # This process builds its cache from the rows it already has instead of reloading them
+        new_cache = build_items_cache(items_with_metadata, pdf_meta.id)
+        async with _catalog_lock:
+            _items_cache = new_cache
         
         return UploadResponse(
             message="PDF set as default pricing table",
@@ -377,7 +676,7 @@ async def get_items_with_green_limit():
             "limite_tabela": {"$ne": ""}  # Ensure limite_tabela has a value
         }
         
-        items = await db.pricing_items.find(query, {"_id": 0}).to_list(10000)
+        items = await db.pricing_items.find(query, {"_id": 0}).to_list(MAX_ITEMS)
         
         green_limit_items = []
         for item in items:
@@ -407,79 +706,52 @@ async def get_batch_quotation(request: BatchQuotationRequest):
         if len(request.item_names) == 0:
             raise HTTPException(status_code=400, detail="At least one keyword required")
         
-        all_items = await db.pricing_items.find({}, {"_id": 0}).to_list(10000)
+        catalog = await get_items_cache()
         
-        if not all_items:
+        if not catalog["size"]:
             raise HTTPException(status_code=404, detail="No pricing data available. Please upload a PDF first.")
         
-        favorites_set = await get_favorites_set()
+        keywords = [keyword.strip() for keyword in request.item_names]
+        keywords = [keyword for keyword in keywords if keyword]
+        
+        # Keywords repeated within a batch (ignoring case) are matched only once, and
+        # the distinct uncached ones are scored together off the event loop
+        unique_keys = list(dict.fromkeys(keyword.lower() for keyword in keywords))
+        raw_matches = await match_keywords_cached(catalog, unique_keys, threshold=60)
+        
+        # Favorites only matter for ordering, so skip them when nothing matched
+        if any(matches for _, matches in raw_matches):
+            favorites_set = await get_favorites_set()
+        else:
+            favorites_set = set()
+        keyword_matches = {
+            key: (exact_match_found, len(matches),
+                  build_matched_items(matches, catalog, favorites_set, limit=request.top_k))
+            for key, (exact_match_found, matches) in zip(unique_keys, raw_matches)
+        }
         
         results = []
         total_items_found = 0
         
-        for keyword in request.item_names:
-            keyword = keyword.strip()
-            
-            if not keyword:
-                continue
-            
-            exact_match_found, matches = fuzzy_match_multiple(keyword, all_items, threshold=60)
-            
-            matched_items = []
-            favorites = []
-            non_favorites = []
-            
-            for matched_item, score in matches:
-                valor_venda = matched_item.get('valor_venda', '')
-                limite_sistema = matched_item.get('limite_sistema', '')
-                limite_tabela = matched_item.get('limite_tabela', '')
-                cinco_porcento = matched_item.get('cinco_porcento', '').strip()
-                
-                fallback_applied = False
-                cinco_porcento_display = cinco_porcento
-                
-                if not cinco_porcento or cinco_porcento == '':
-                    cinco_porcento_display = limite_tabela if limite_tabela else 'N/A'
-                    fallback_applied = True if limite_tabela else False
-                
-                is_favorite = matched_item['produto'] in favorites_set
-                
-                item_detail = MatchedItemDetail(
-                    item_id=matched_item['id'],
-                    matched_item_name=matched_item['produto'],
-                    valor_venda=valor_venda if valor_venda else 'N/A',
-                    limite_sistema=limite_sistema if limite_sistema else 'N/A',
-                    limite_tabela=limite_tabela if limite_tabela else 'N/A',
-                    cinco_porcento_original=cinco_porcento if cinco_porcento else 'N/A',
-                    cinco_porcento_display=cinco_porcento_display if cinco_porcento_display else 'N/A',
-                    fallback_applied=fallback_applied,
-                    is_favorite=is_favorite,
-                    valor_venda_color=matched_item.get('valor_venda_color'),
-                    limite_sistema_color=matched_item.get('limite_sistema_color'),
-                    limite_tabela_color=matched_item.get('limite_tabela_color'),
-                    cinco_porcento_color=matched_item.get('cinco_porcento_color')
-                )
-                
-                if is_favorite:
-                    favorites.append(item_detail)
-                else:
-                    non_favorites.append(item_detail)
-            
-            matched_items = favorites + non_favorites
-            total_items_found += len(matched_items)
+        for keyword in keywords:
+            # Totals count every match, even those cut by top_k
+            exact_match_found, total_matches, matched_items = keyword_matches[keyword.lower()]
+            total_items_found += total_matches
             
-            results.append(KeywordResults(
+            results.append(KeywordResults.model_construct(
                 keyword=keyword,
                 matches=matched_items,
-                total_matches=len(matched_items),
+                total_matches=total_matches,
                 exact_match_found=exact_match_found
             ))
         
-        return BatchQuotationResponse(
+        # Returning a response object directly skips FastAPI's re-validation of the
+        # whole payload against response_model, which is still used for the schema
+        return ORJSONResponse(BatchQuotationResponse.model_construct(
             results=results,
             total_keywords=len(results),
             total_items_found=total_items_found
-        )
+        ).model_dump())
     
     except HTTPException:
         raise
@@ -491,15 +763,29 @@ async def get_batch_quotation(request: BatchQuotationRequest):
 async def add_favorite(request: FavoriteRequest):
     """Add item to favorites"""
     try:
-        existing = await db.favorites.find_one({"item_name": request.item_name})
-        
-        if existing:
-            return {"message": "Item already in favorites", "status": "exists"}
-        
         fav = FavoriteItem(item_name=request.item_name)
         doc = fav.model_dump()
-        doc['timestamp'] = doc['timestamp'].isoformat()
-        await db.favorites.insert_one(doc)
+        # item_name comes from the filter on insert
+        doc.pop('item_name')
+        
+        # A single idempotent upsert replaces the find_one + insert_one pair
+        async with _favorites_lock:
+            try:
+                result = await db.favorites.update_one(
+                    {"item_name": request.item_name},
+                    {"$setOnInsert": doc},
+                    upsert=True
+                )
+                inserted = result.upserted_id is not None
+            except DuplicateKeyError:
+                # A concurrent upsert (e.g. from another server process) inserted it first
+                inserted = False
+            
+            if _favorites_cache is not None:
+                _favorites_cache.add(request.item_name)
+        
+        if not inserted:
+            return {"message": "Item already in favorites", "status": "exists"}
         
         return {"message": "Item added to favorites", "status": "added"}
     
@@ -511,7 +797,11 @@ async def add_favorite(request: FavoriteRequest):
 async def remove_favorite(request: FavoriteRequest):
     """Remove item from favorites"""
     try:
-        result = await db.favorites.delete_one({"item_name": request.item_name})
+        async with _favorites_lock:
+            result = await db.favorites.delete_one({"item_name": request.item_name})
+            
+            if _favorites_cache is not None:
+                _favorites_cache.discard(request.item_name)
         
         if result.deleted_count > 0:
             return {"message": "Item removed from favorites", "status": "removed"}
@@ -543,15 +833,13 @@ async def get_default_pdf_status():
         )
         
         if default_pdf:
-            upload_ts = default_pdf.get('upload_timestamp')
-            if isinstance(upload_ts, str):
-                upload_ts = datetime.fromisoformat(upload_ts)
-            
+            # Documents written before timestamps were stored as dates hold ISO
+            # strings, which pydantic parses on its own
             return DefaultPDFStatus(
                 has_default=True,
                 filename=default_pdf['filename'],
                 items_count=default_pdf['items_count'],
-                upload_timestamp=upload_ts
+                upload_timestamp=default_pdf.get('upload_timestamp')
             )
         else:
             return DefaultPDFStatus(has_default=False)
@@ -563,21 +851,24 @@ async def get_default_pdf_status():
 @api_router.get("/items", response_model=List[PricingItem])
 async def get_all_items(limit: int = 100):
     """Get all pricing items"""
-    items = await db.pricing_items.find({}, {"_id": 0}).limit(limit).to_list(limit)
-    
-    for item in items:
-        if isinstance(item.get('timestamp'), str):
-            item['timestamp'] = datetime.fromisoformat(item['timestamp'])
-    
-    return items
+    # Timestamps are BSON dates already; response_model validation handles the rest
+    return await db.pricing_items.find({}, {"_id": 0}).limit(limit).to_list(limit)
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Parsed once into a tuple. A wildcard origin cannot be combined with credentials
+# without echoing each request's origin, so credentials are only allowed for an
+# explicit origin list.
+CORS_ORIGINS = tuple(
+    origin.strip() for origin in os.environ.get('CORS_ORIGINS', '*').split(',') if origin.strip()
+)
+CORS_ALLOW_ALL = CORS_ORIGINS == ('*',)
+
 app.add_middleware(
     CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+    allow_credentials=not CORS_ALLOW_ALL,
+    allow_origins=CORS_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -589,6 +880,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    # Built one by one so a failing index (e.g. duplicate favorites left over from
+    # before the unique index existed) does not skip the others
+    try:
+        await db.favorites.create_index("item_name", unique=True)
+    except Exception as e:
+        logging.error(f"Error creating favorites index: {str(e)}")
+    
+    try:
+        await db.pdf_metadata.create_index("is_default")
+    except Exception as e:
+        logging.error(f"Error creating pdf_metadata index: {str(e)}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown()
\ No newline at end of file
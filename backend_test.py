@@ -47,6 +47,8 @@ class PDFPricingAPITester:
                     response = requests.post(url, files=files, data=data, timeout=60)
                 else:
                     response = requests.post(url, json=data, headers=headers, timeout=30)
+            elif method == 'DELETE':
+                response = requests.delete(url, json=data, headers=headers, timeout=30)
 
             success = response.status_code == expected_status
             
@@ -204,6 +206,75 @@ class PDFPricingAPITester:
             data={"item_names": []}
         )
 
+    def test_batch_quotation_top_k(self):
+        """Test that top_k caps the matches while total_matches still counts all of them"""
+        success, response = self.run_test(
+            "Batch Quotation (top_k=3)",
+            "POST",
+            "quotation-batch",
+            200,
+            data={"item_names": ["LED"], "top_k": 3}
+        )
+        
+        if success:
+            result = response["results"][0]
+            ok = len(result["matches"]) <= 3 and result["total_matches"] >= len(result["matches"])
+            self.log_test(
+                "top_k Limits Matches", ok,
+                f"Returned {len(result['matches'])} of {result['total_matches']} matches"
+            )
+        return success, response
+
+    def test_batch_quotation_top_k_favorite(self):
+        """Test that a favorite ranked below the top_k cut is still returned first"""
+        success, response = self.run_test(
+            "Batch Quotation (Full Ranking)",
+            "POST",
+            "quotation-batch",
+            200,
+            data={"item_names": ["LED"]}
+        )
+        
+        if not success or len(response["results"][0]["matches"]) < 2:
+            self.log_test("top_k Keeps Favorites", False, "Need at least 2 matches for LED")
+            return False, {}
+        
+        # Lowest ranked non-favorite match, so it falls outside top_k=1 by score
+        candidates = [m for m in response["results"][0]["matches"] if not m["is_favorite"]]
+        favorite_name = candidates[-1]["matched_item_name"]
+        self.run_test("Add Favorite", "POST", "favorites/add", 200, data={"item_name": favorite_name})
+        
+        try:
+            success, response = self.run_test(
+                "Batch Quotation (top_k=1 with Favorite)",
+                "POST",
+                "quotation-batch",
+                200,
+                data={"item_names": ["LED"], "top_k": 1}
+            )
+            
+            if success:
+                matches = response["results"][0]["matches"]
+                ok = (
+                    len(matches) == 1
+                    and matches[0]["matched_item_name"] == favorite_name
+                    and matches[0]["is_favorite"]
+                )
+                self.log_test("top_k Keeps Favorites", ok, f"Got {[m['matched_item_name'] for m in matches]}")
+            return success, response
+        finally:
+            self.run_test("Remove Favorite", "DELETE", "favorites/remove", 200, data={"item_name": favorite_name})
+
+    def test_batch_quotation_top_k_zero(self):
+        """Test that top_k=0 is rejected"""
+        return self.run_test(
+            "Batch Quotation (top_k=0)",
+            "POST",
+            "quotation-batch",
+            422,
+            data={"item_names": ["LED"], "top_k": 0}
+        )
+
     def run_all_tests(self):
         """Run all tests in sequence"""
         print("🚀 Starting PDF Pricing API Tests")
@@ -227,10 +298,13 @@ class PDFPricingAPITester:
             self.test_batch_quotation_valid()
             self.test_batch_quotation_fuzzy_match()
             self.test_batch_quotation_max_items()
+            self.test_batch_quotation_top_k()
+            self.test_batch_quotation_top_k_favorite()
             
             # Test error cases
             self.test_batch_quotation_too_many_items()
             self.test_batch_quotation_empty()
+            self.test_batch_quotation_top_k_zero()
         else:
             print("\n⚠️  PDF upload failed - skipping data-dependent tests")
 